@@ -51,3 +51,70 @@ CREATE TABLE visread_books (
     -- Timestamp of when the book was created.
     created_at TIMESTAMPTZ DEFAULT now()
 );
+
+-- ####################################################################
+-- Full-text and trigram search over a user's library.
+-- ####################################################################
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- array_to_string is only STABLE, so generated columns need an IMMUTABLE wrapper.
+CREATE OR REPLACE FUNCTION visread_chapters_text(chapters TEXT[])
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$ SELECT coalesce(array_to_string(chapters, ' '), '') $$;
+
+-- Weighted search document: title (A), author (B), chapter text (C).
+ALTER TABLE visread_books ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(author, '')), 'B') ||
+        setweight(to_tsvector('english', visread_chapters_text(chapters)), 'C')
+    ) STORED;
+
+CREATE INDEX visread_books_user_id_idx ON visread_books (user_id, created_at DESC);
+CREATE INDEX visread_books_search_idx ON visread_books USING GIN (search_vector);
+-- Trigram indexes make fuzzy and partial title/author matches fast.
+CREATE INDEX visread_books_title_trgm_idx ON visread_books USING GIN (title gin_trgm_ops);
+CREATE INDEX visread_books_author_trgm_idx ON visread_books USING GIN (author gin_trgm_ops);
+
+-- Ranked, paginated search. Returns one row per matching book with the
+-- chapter (page_index, zero-based) that best matches the query.
+CREATE OR REPLACE FUNCTION search_visread_books(
+    p_user_id UUID,
+    p_query TEXT,
+    p_limit INT DEFAULT 20,
+    p_offset INT DEFAULT 0
+)
+RETURNS TABLE (book_id BIGINT, title TEXT, author TEXT, page_index INT, snippet TEXT, rank REAL)
+LANGUAGE sql STABLE
+AS $$
+    WITH q AS (
+        SELECT websearch_to_tsquery('english', p_query) AS tsq
+    ),
+    matches AS (
+        SELECT b.id, b.title, b.author, b.chapters,
+               ts_rank(b.search_vector, q.tsq)
+                 + greatest(similarity(b.title, p_query), similarity(coalesce(b.author, ''), p_query)) AS rank
+        FROM visread_books b, q
+        WHERE b.user_id = p_user_id
+          AND (b.search_vector @@ q.tsq OR b.title % p_query OR b.author % p_query)
+        ORDER BY rank DESC, b.id DESC
+        LIMIT p_limit OFFSET p_offset
+    )
+    SELECT m.id, m.title, m.author,
+           coalesce(best.n - 1, 0)::INT AS page_index,
+           best.snippet,
+           m.rank::REAL
+    FROM matches m
+    CROSS JOIN q
+    LEFT JOIN LATERAL (
+        SELECT c.n,
+               ts_headline('english', c.body, q.tsq, 'MaxWords=30, MinWords=10') AS snippet
+        FROM unnest(m.chapters) WITH ORDINALITY AS c(body, n)
+        WHERE to_tsvector('english', c.body) @@ q.tsq
+        ORDER BY ts_rank(to_tsvector('english', c.body), q.tsq) DESC, c.n
+        LIMIT 1
+    ) best ON true
+    ORDER BY m.rank DESC, m.id DESC;
+$$;
@@ -0,0 +1,96 @@
+import os
+import shutil
+import threading
+import time
+
+# --- Local Candidate Store ---
+# Spare renders for a chapter are kept on local disk until the reader asks for
+# a different image, so "regenerate" can switch to the next candidate at once
+# instead of running the whole prompt, render and upload chain again. Only
+# the candidate that is actually shown is ever uploaded. The least recently
+# filled pages are evicted once more than MAX_CANDIDATE_PAGES have spares.
+
+CANDIDATE_COUNT = int(os.environ.get("VISREAD_CANDIDATES", "3"))
+MAX_CANDIDATE_PAGES = int(os.environ.get("VISREAD_MAX_CANDIDATE_PAGES", "200"))
+CANDIDATE_DIR = os.path.join(os.path.expanduser("~"), "VisRead", "candidates")
+PROMPT_FILE = "prompt.txt"
+
+
+class CandidateStore:
+    def __init__(self, root=CANDIDATE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _dir(self, book_id, page_index):
+        return os.path.join(self.root, str(book_id), str(page_index))
+
+    def _files(self, directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if name.endswith(".png"))
+
+    def _evict(self, keep):
+        """Removes the least recently written page directories beyond MAX_CANDIDATE_PAGES."""
+        pages = []
+        for book in os.listdir(self.root):
+            book_dir = os.path.join(self.root, book)
+            if not os.path.isdir(book_dir):
+                continue
+            for name in os.listdir(book_dir):
+                path = os.path.join(book_dir, name)
+                if path != keep and os.path.isdir(path):
+                    pages.append((os.path.getmtime(path), path))
+        pages.sort()
+        for _, path in pages[:max(0, len(pages) + 1 - MAX_CANDIDATE_PAGES)]:
+            shutil.rmtree(path, ignore_errors=True)
+            if not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+
+    def add(self, book_id, page_index, image_bytes, prompt=None):
+        directory = self._dir(book_id, page_index)
+        with self._lock:
+            is_new = not os.path.isdir(directory)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{time.time_ns()}.png"), "wb") as f:
+                f.write(image_bytes)
+            if prompt:
+                with open(os.path.join(directory, PROMPT_FILE), "w", encoding="utf-8") as f:
+                    f.write(prompt)
+            if is_new and MAX_CANDIDATE_PAGES:
+                self._evict(directory)
+
+    def count(self, book_id, page_index):
+        with self._lock:
+            return len(self._files(self._dir(book_id, page_index)))
+
+    def pop(self, book_id, page_index):
+        """Removes and returns the oldest stored candidate, or None."""
+        directory = self._dir(book_id, page_index)
+        with self._lock:
+            files = self._files(directory)
+            if not files:
+                return None
+            path = os.path.join(directory, files[0])
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+            return data
+
+    def prompt(self, book_id, page_index):
+        """The prompt the stored candidates were rendered from, so refills can skip Gemma."""
+        path = os.path.join(self._dir(book_id, page_index), PROMPT_FILE)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+
+    def clear(self, book_id, page_index=None):
+        with self._lock:
+            if page_index is None:
+                shutil.rmtree(os.path.join(self.root, str(book_id)), ignore_errors=True)
+            else:
+                shutil.rmtree(self._dir(book_id, page_index), ignore_errors=True)
+
+
+candidate_store = CandidateStore()
@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Provider Client Registry ---
+# Clients are created once, shared by every thread, and can be warmed in the
+# background at startup so the first image does not pay the setup cost.
+
+GEMMA_MODEL_NAME = "gemma-3-27b-it"
+IMAGEN_MODEL_NAME = "gemini-2.0-flash-preview-image-generation"
+DEFAULT_FLUX_SPACE = "black-forest-labs/FLUX.1-Krea-dev"
+
+# Seconds an endpoint that failed to initialize is skipped before retrying it.
+FLUX_RETRY_COOLDOWN = 60
+
+_genai_lock = threading.Lock()
+_genai_configured = False
+_gemma_lock = threading.Lock()
+_gemma_model = None
+_imagen_lock = threading.Lock()
+_imagen_model = None
+
+
+def _configure_genai():
+    """Configures google.generativeai exactly once, returning the module."""
+    global _genai_configured
+    import google.generativeai as genai
+    if _genai_configured:
+        return genai
+    with _genai_lock:
+        if not _genai_configured:
+            GOOGLE_API_KEY = os.environ.get("GOOGLE_AI_API_KEY")
+            if not GOOGLE_API_KEY:
+                raise ValueError("GOOGLE_AI_API_KEY is not set.")
+            genai.configure(api_key=GOOGLE_API_KEY)
+            _genai_configured = True
+    return genai
+
+
+def get_gemma_model():
+    """Returns the shared Gemma model, or None if it cannot be configured."""
+    global _gemma_model
+    if _gemma_model is not None:
+        return _gemma_model
+    with _gemma_lock:
+        if _gemma_model is None:
+            print("--- Initializing Gemma ---")
+            try:
+                genai = _configure_genai()
+                _gemma_model = genai.GenerativeModel(GEMMA_MODEL_NAME)
+                print("--- Gemma configured successfully ---")
+            except Exception as e:
+                print(f"Error configuring Google AI for Gemma: {e}")
+    return _gemma_model
+
+
+def get_imagen_model():
+    """Returns the shared Gemini image model. Raises if it cannot be configured."""
+    global _imagen_model
+    if _imagen_model is not None:
+        return _imagen_model
+    with _imagen_lock:
+        if _imagen_model is None:
+            print("--- Initializing Gemini for Image Generation ---")
+            try:
+                genai = _configure_genai()
+                _imagen_model = genai.GenerativeModel(IMAGEN_MODEL_NAME)
+                print("--- Gemini (Imagen) configured successfully ---")
+            except Exception as e:
+                print(f"Error configuring Gemini for Image Generation: {e}")
+                raise
+    return _imagen_model
+
+
+class FluxEndpoint:
+    """A single FLUX Gradio endpoint (a HF Space id or a self-hosted URL)."""
+
+    def __init__(self, src):
+        self.src = src
+        self.client = None
+        self.in_flight = 0
+        # Last queue position reported by a job on this endpoint
+        self.last_queue_position = 0
+        self.queue_seen_at = 0.0
+        self.failed_at = None
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        if self.failed_at is None:
+            return True
+        return time.monotonic() - self.failed_at >= FLUX_RETRY_COOLDOWN
+
+    def queue_load(self):
+        """The last observed queue position, forgotten once it is stale."""
+        if time.monotonic() - self.queue_seen_at > FLUX_RETRY_COOLDOWN:
+            return 0
+        return self.last_queue_position
+
+    def get_client(self):
+        if self.client is not None:
+            return self.client
+        with self._lock:
+            if self.client is None:
+                print(f"--- Initializing FLUX client for {self.src} ---")
+                from gradio_client import Client
+                try:
+                    hf_token = os.environ.get("HF_TOKEN")
+                    self.client = Client(self.src, hf_token=hf_token) if hf_token else Client(self.src)
+                    self.failed_at = None
+                    print(f"--- FLUX client for {self.src} initialized ---")
+                except Exception as e:
+                    self.failed_at = time.monotonic()
+                    print(f"Error initializing FLUX client for {self.src}: {e}")
+                    raise
+        return self.client
+
+
+class FluxPool:
+    """
+    Balances FLUX requests across several endpoints, sending each request to
+    the available endpoint with the lowest load: requests in flight plus the
+    queue position its last job observed.
+    """
+
+    def __init__(self, sources):
+        self.endpoints = [FluxEndpoint(src) for src in sources]
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _pick(self, exclude=()):
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep.is_available() and ep not in exclude]
+            if not candidates:
+                return None
+            # Rotate the starting point so ties are spread round-robin.
+            start = self._next % len(candidates)
+            self._next += 1
+            rotated = candidates[start:] + candidates[:start]
+            endpoint = min(rotated, key=lambda ep: ep.in_flight + ep.queue_load())
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    @contextmanager
+    def acquire(self):
+        """Yields (endpoint, client) for the least loaded endpoint that initializes."""
+        tried = []
+        last_error = None
+        while True:
+            endpoint = self._pick(exclude=tried)
+            if endpoint is None:
+                raise RuntimeError(f"No FLUX endpoint available: {last_error}")
+            try:
+                client = endpoint.get_client()
+            except Exception as e:
+                self._release(endpoint)
+                tried.append(endpoint)
+                last_error = e
+                continue
+            break
+        try:
+            yield endpoint, client
+        finally:
+            self._release(endpoint)
+
+    def warm_up(self):
+        for endpoint in self.endpoints:
+            try:
+                endpoint.get_client()
+            except Exception:
+                pass
+
+
+def _flux_sources():
+    """Reads FLUX_SPACES (comma-separated Space ids or URLs) from the environment."""
+    raw = os.environ.get("FLUX_SPACES", "")
+    sources = [s.strip() for s in raw.split(",") if s.strip()]
+    return sources or [DEFAULT_FLUX_SPACE]
+
+
+flux_pool = FluxPool(_flux_sources())
+
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+
+
+def warm_up():
+    """Initializes every provider client on a background thread (once per process)."""
+    global _warm_up_thread
+
+    def _warm():
+        print("--- Warming up provider clients ---")
+        get_gemma_model()
+        try:
+            get_imagen_model()
+        except Exception:
+            pass
+        flux_pool.warm_up()
+        print("--- Provider clients warm ---")
+
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_warm, name="visread-warmup", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
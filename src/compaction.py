@@ -0,0 +1,170 @@
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+# --- Token-Budgeted Text Compaction ---
+# Long paragraphs are reduced to their most visually relevant sentences before
+# they are sent to Gemma. Sentences are scored locally (named entities,
+# setting, lighting, appearance and action cues) and picked greedily within the
+# token budget, keeping their original order. An LLM summary is only requested
+# when the extract drops one of the paragraph's main scene cues, its input is
+# capped so latency stays bounded, and it is cached per paragraph.
+
+TOKEN_BUDGET = int(os.environ.get("VISREAD_PROMPT_TOKEN_BUDGET", "300"))
+# The extract must keep this many of the paragraph's most frequent scene cues, or a summary is requested.
+TOP_SCENE_CUES = 6
+# The summary call sees at most this many times the budget.
+SUMMARY_INPUT_FACTOR = 4
+# Word counts only roughly predict tokens, so a summary may overshoot the budget by this factor.
+SUMMARY_OVERSHOOT = 1.25
+MAX_CACHED_SUMMARIES = 256
+
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])["”’]?\s+(?=["“‘(]?[A-Z0-9])|\n+')
+_WORD_RE = re.compile(r"[A-Za-z']+")
+
+VISUAL_CUES = {
+    # setting
+    "room", "hall", "forest", "city", "street", "castle", "tower", "village", "sea", "ocean", "river",
+    "mountain", "sky", "field", "garden", "palace", "temple", "cave", "desert", "ship", "door", "window",
+    "throne", "bridge", "road", "market", "tavern", "library", "battlefield", "lake", "shore", "ruins",
+    # lighting and atmosphere
+    "light", "dark", "darkness", "shadow", "shadows", "sun", "sunlight", "moon", "moonlight", "fire", "flame",
+    "flames", "glow", "glowing", "candle", "lantern", "mist", "fog", "rain", "snow", "storm", "night",
+    "dawn", "dusk", "twilight", "smoke", "stars", "lightning", "gleaming", "shimmering", "bright",
+    # appearance
+    "hair", "eyes", "face", "robe", "robes", "cloak", "armor", "armour", "dress", "sword", "blade", "crown",
+    "scar", "wings", "tall", "pale", "young", "old", "wore", "wearing", "clad",
+    # colours
+    "red", "crimson", "scarlet", "blue", "azure", "green", "emerald", "gold", "golden", "silver", "black",
+    "white", "grey", "gray", "purple", "violet", "amber", "orange",
+    # action
+    "stood", "ran", "fell", "rose", "raised", "drew", "struck", "leapt", "knelt", "walked", "rode", "flew",
+    "fought", "charged", "climbed", "held", "gripped", "turned", "collapsed", "burst", "shattered",
+}
+
+_SPEECH_RE = re.compile(r'["“][^"”]*["”]')
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def split_sentences(text):
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s and s.strip()]
+
+
+def score_sentence(sentence, position):
+    """Scores how much a sentence contributes to a picture of the scene."""
+    narration = _SPEECH_RE.sub(" ", sentence)
+    words = _WORD_RE.findall(narration)
+    if not words:
+        return 0.0
+    cues = sum(1 for w in words if w.lower() in VISUAL_CUES)
+    # Capitalised words that do not start the sentence are likely names and places.
+    entities = sum(1 for w in words[1:] if w[0].isupper())
+    score = cues * 2.0 + entities * 1.5
+    if position == 0:
+        score += 2.0  # Opening sentences usually establish the scene
+    # Favour dense sentences over long ones.
+    return score / (1 + len(words) / 25)
+
+
+def scene_cues(text, top=TOP_SCENE_CUES):
+    """The most frequent visual cue words and likely names in text, most frequent first."""
+    counts = Counter()
+    for sentence in split_sentences(_SPEECH_RE.sub(" ", text)):
+        words = _WORD_RE.findall(sentence)
+        for i, w in enumerate(words):
+            if w.lower() in VISUAL_CUES:
+                counts[w.lower()] += 1
+            elif i > 0 and w[0].isupper():
+                counts[w] += 1
+    return [cue for cue, _ in counts.most_common(top)]
+
+
+def missing_scene_cues(text, extract, top=TOP_SCENE_CUES):
+    """The top scene cues of text that the extract no longer mentions."""
+    kept = {w.lower() for w in _WORD_RE.findall(extract)}
+    return [cue for cue in scene_cues(text, top) if cue.lower() not in kept]
+
+
+def extract_visual_text(text, budget=TOKEN_BUDGET):
+    """
+    Returns (extract, coverage): the highest scoring sentences that fit within
+    budget, in their original order, and the fraction of the text's total
+    visual score they carry.
+    """
+    sentences = split_sentences(text)
+    scored = [(score_sentence(s, i), i, s) for i, s in enumerate(sentences)]
+    total = sum(score for score, _, _ in scored) or 1.0
+
+    chosen = []
+    seen = set()
+    used = 0
+    kept = 0.0
+    for score, i, sentence in sorted(scored, key=lambda item: item[0], reverse=True):
+        # Sentences with no visual cues and verbatim repeats are never worth their tokens
+        if score <= 0 or sentence in seen:
+            continue
+        cost = estimate_tokens(sentence)
+        if used + cost > budget:
+            continue
+        chosen.append(i)
+        seen.add(sentence)
+        used += cost
+        kept += score
+    chosen.sort()
+    return " ".join(sentences[i] for i in chosen), kept / total
+
+
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
+
+
+def _cached_summary(key):
+    with _summaries_lock:
+        summary = _summaries.get(key)
+        if summary is not None:
+            _summaries.move_to_end(key)
+        return summary
+
+
+def _cache_summary(key, summary):
+    with _summaries_lock:
+        _summaries[key] = summary
+        while len(_summaries) > MAX_CACHED_SUMMARIES:
+            _summaries.popitem(last=False)
+
+
+def compact_text(text, budget=TOKEN_BUDGET, summarize=None):
+    """
+    Keeps text within the token budget. Short text is returned unchanged; long
+    text is reduced to its visual sentences, and summarize(text, budget) (an LLM call)
+    is only used when that extract drops one of the paragraph's main scene cues.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+
+    extract, coverage = extract_visual_text(text, budget)
+    missing = missing_scene_cues(text, extract)
+    print(f"--- Compacted text from ~{estimate_tokens(text)} to ~{estimate_tokens(extract)} tokens (visual coverage {coverage:.0%}, missing cues: {missing or 'none'}) ---")
+    if (extract and not missing) or summarize is None:
+        return extract or text[:budget * 4]
+
+    key = (hashlib.sha1(text.encode("utf-8")).hexdigest(), budget)
+    summary = _cached_summary(key)
+    if summary is None:
+        summary_input, _ = extract_visual_text(text, budget * SUMMARY_INPUT_FACTOR)
+        try:
+            summary = summarize(summary_input or text[:budget * 4 * SUMMARY_INPUT_FACTOR], budget)
+        except Exception as e:
+            print(f"Summary for compaction failed: {e}")
+            summary = None
+        if summary and estimate_tokens(summary) <= budget * SUMMARY_OVERSHOOT:
+            _cache_summary(key, summary)
+        else:
+            summary = None
+    return summary or extract or text[:budget * 4]
@@ -0,0 +1,250 @@
+import html
+import io
+import json
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+# --- Offline Book Export ---
+# Books are exported as EPUB files. Chapter images are fetched concurrently
+# over one pooled HTTP session, with at most MAX_IN_FLIGHT downloads pending
+# at a time, and each image is written into the archive as soon as it arrives
+# so memory use does not grow with the size of the book. A visread.json
+# manifest inside the archive lets the reader open it without any network.
+
+EXPORT_DIR = os.path.join(os.path.expanduser("~"), "VisRead", "exports")
+MANIFEST_NAME = "visread.json"
+FETCH_WORKERS = 8
+MAX_IN_FLIGHT = 16
+FETCH_TIMEOUT = 30
+
+
+def _make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _recompress(data, max_width, quality):
+    """Re-encodes an image as JPEG, downscaling it to max_width if it is wider."""
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if max_width and image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _image_ext(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png", "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg", "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return "png", "image/png"
+
+
+def fetch_images(urls, workers=FETCH_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Fetches {index: url} concurrently, yielding (index, bytes or None) in index
+    order, with at most max_in_flight downloads outstanding.
+    """
+    session = _make_session()
+
+    def fetch(index, url):
+        try:
+            response = session.get(url, timeout=FETCH_TIMEOUT)
+            response.raise_for_status()
+            return index, response.content
+        except Exception as e:
+            print(f"Failed to fetch image {index} ({url}): {e}")
+            return index, None
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, url in sorted(urls.items()):
+            pending.append(executor.submit(fetch, index, url))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    session.close()
+
+
+def _chapter_xhtml(title, index, text, image_name):
+    paragraphs = "".join(f"<p>{html.escape(p)}</p>" for p in text.split("\n\n"))
+    image = f'<div class="image"><img src="{image_name}" alt=""/></div>' if image_name else ""
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml">'
+        f"<head><title>{html.escape(title)} - {index + 1}</title>"
+        '<link rel="stylesheet" href="style.css"/></head>'
+        f"<body>{image}{paragraphs}</body></html>"
+    )
+
+
+def _safe_filename(title):
+    name = re.sub(r"[^\w\- ]+", "", title or "book").strip().replace(" ", "_")
+    return name or "book"
+
+
+def export_book(book, path=None, recompress=False, max_width=1280, quality=80, on_progress=None):
+    """
+    Writes a book (a visread_books row) to an EPUB at path and returns the path.
+    With recompress=True images are re-encoded as JPEG to shrink the archive.
+    on_progress(done, total) is called after each image is written.
+    """
+    chapters = book.get("chapters") or []
+    images = {int(k): v for k, v in (book.get("images") or {}).items() if v and int(k) < len(chapters)}
+    title = book.get("title") or "Untitled"
+    if path is None:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = os.path.join(EXPORT_DIR, f"{_safe_filename(title)}_{book.get('id', '')}.epub")
+
+    image_files = {}
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        # The EPUB spec requires an uncompressed mimetype entry first.
+        archive.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        archive.writestr("META-INF/container.xml", (
+            '<?xml version="1.0"?>'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+            '</container>'
+        ))
+        archive.writestr("OEBPS/style.css", "body{font-family:serif;margin:1em}.image{text-align:center}img{max-width:100%}")
+
+        done = 0
+        for index, data in fetch_images(images):
+            if data:
+                if recompress:
+                    try:
+                        data = _recompress(data, max_width, quality)
+                    except Exception as e:
+                        print(f"Failed to re-compress image {index}: {e}")
+                ext, media_type = _image_ext(data)
+                name = f"images/{index}.{ext}"
+                # Already compressed formats gain nothing from deflate.
+                archive.writestr(f"OEBPS/{name}", data, compress_type=zipfile.ZIP_STORED)
+                image_files[index] = (name, media_type)
+            done += 1
+            if on_progress:
+                on_progress(done, len(images))
+
+        for index, text in enumerate(chapters):
+            image_name = image_files.get(index, (None,))[0]
+            archive.writestr(f"OEBPS/chapter_{index}.xhtml", _chapter_xhtml(title, index, text, image_name))
+
+        manifest_items = [
+            '<item id="style" href="style.css" media-type="text/css"/>',
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+        ]
+        manifest_items += [
+            f'<item id="img{i}" href="{name}" media-type="{media_type}"/>' for i, (name, media_type) in sorted(image_files.items())
+        ]
+        manifest_items += [
+            f'<item id="ch{i}" href="chapter_{i}.xhtml" media-type="application/xhtml+xml"/>' for i in range(len(chapters))
+        ]
+        spine = "".join(f'<itemref idref="ch{i}"/>' for i in range(len(chapters)))
+        author = book.get("author")
+        # EPUB 3 requires dcterms:modified; an empty dc:creator is invalid, so it is left out
+        creator = f"<dc:creator>{html.escape(author)}</dc:creator>" if author else ""
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        archive.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="bookid">visread-{book.get("id", "")}</dc:identifier>'
+            f"<dc:title>{html.escape(title)}</dc:title>"
+            f"{creator}"
+            "<dc:language>en</dc:language>"
+            f'<meta property="dcterms:modified">{modified}</meta>'
+            "</metadata>"
+            f"<manifest>{''.join(manifest_items)}</manifest>"
+            f"<spine>{spine}</spine>"
+            "</package>"
+        ))
+        nav_items = "".join(f'<li><a href="chapter_{i}.xhtml">{i + 1}</a></li>' for i in range(len(chapters)))
+        archive.writestr("OEBPS/nav.xhtml", (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f"<head><title>{html.escape(title)}</title></head>"
+            f'<body><nav epub:type="toc"><ol>{nav_items}</ol></nav></body></html>'
+        ))
+        archive.writestr(MANIFEST_NAME, json.dumps({
+            "id": book.get("id"),
+            "user_id": book.get("user_id"),
+            "title": title,
+            "author": book.get("author"),
+            "style_guide": book.get("style_guide"),
+            "chapters": chapters,
+            "images": {str(i): f"OEBPS/{name}" for i, (name, _) in image_files.items()},
+        }))
+
+    print(f"--- Exported '{title}' to {path} ---")
+    return path
+
+
+class ArchiveBook:
+    """
+    A book opened from an exported archive. Only the manifest is kept in memory;
+    the zip is reopened briefly for each image so no file handle stays open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as archive:
+            manifest = json.loads(archive.read(MANIFEST_NAME))
+        self.book = {
+            "id": manifest.get("id"),
+            "user_id": manifest.get("user_id"),
+            "title": manifest.get("title") or "Untitled",
+            "author": manifest.get("author"),
+            "style_guide": manifest.get("style_guide"),
+            "chapters": manifest.get("chapters") or [],
+            "images": manifest.get("images") or {},
+        }
+
+    def read_image(self, page_index):
+        name = self.book["images"].get(str(page_index))
+        if not name:
+            return None
+        with zipfile.ZipFile(self.path) as archive:
+            return archive.read(name)
+
+
+MAX_CACHED_ARCHIVES = 16
+_open_archives = OrderedDict()
+_open_archives_lock = threading.Lock()
+
+
+def open_archive(path):
+    """Returns a cached ArchiveBook for path, reloading it if the file changed."""
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    with _open_archives_lock:
+        cached = _open_archives.get(path)
+        if cached is not None and cached[0] == mtime:
+            _open_archives.move_to_end(path)
+            return cached[1]
+    archive = ArchiveBook(path)
+    with _open_archives_lock:
+        _open_archives[path] = (mtime, archive)
+        _open_archives.move_to_end(path)
+        while len(_open_archives) > MAX_CACHED_ARCHIVES:
+            _open_archives.popitem(last=False)
+    return archive
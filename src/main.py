@@ -1,5 +1,6 @@
 import flet as ft
 import io
+import os
 import re
 import bcrypt
 from datetime import datetime
@@ -7,6 +8,7 @@ import cloudinary.uploader as uploader
 import logging
 import sys
 import time # ADDED: Import the time module
+import base64
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -36,10 +38,14 @@ print("--- Application starting up ---")
 
 # Use direct imports for desktop application
 from connection import supabase
-from pipeline import generate_image, create_style_guide
-
-# --- Global State ---
-current_user = None
+from pipeline import build_image_prompt, render_image, render_candidate, create_style_guide
+from candidates import candidate_store, CANDIDATE_COUNT
+from prompt_builder import scene_part
+from similarity import get_book_index, REUSE_MODE
+from export import export_book, open_archive
+from search import search_books
+from clients import warm_up
+from sessions import get_current_user, set_current_user, generation_pool, QuotaExceeded
 
 # --- UI Constants & Theming ---
 MAX_CONTENT_WIDTH = 1200 # Increased for the new layout
@@ -94,6 +100,7 @@ def upload_image_to_cloudinary(image_data, public_id):
 # --- Main Application Logic ---
 
 def main(page: ft.Page):
+    warm_up()
     page.title = "VisRead"
     page.window_width = 1280
     page.window_height = 800
@@ -119,6 +126,7 @@ def main(page: ft.Page):
 
     def navigate_to(route_path: str, **kwargs):
         if route_path == "login":
+            set_current_user(page, None)
             page.views.clear()
             page.views.append(login_view(page, get_theme, navigate_to, toggle_theme))
         elif route_path == "register":
@@ -144,8 +152,7 @@ def login_view(page, get_theme, navigate_to, toggle_theme):
             response = supabase.table('visread_users').select('*').eq('username', username_field.value).single().execute()
             user_data = response.data
             if user_data and bcrypt.checkpw(password_field.value.encode('utf-8'), user_data["password"].encode("utf-8")):
-                global current_user
-                current_user = user_data
+                set_current_user(page, user_data)
                 navigate_to("app")
             else:
                 error_msg.value = "Invalid username or password"
@@ -383,7 +390,7 @@ def new_book_view(page, get_theme, navigate_to):
         chapters = process_text(content_field.value)
         book_doc = {
             "title": title_field.value, "author": author_field.value, "chapters": chapters,
-            "user_id": current_user["id"], "images": {},
+            "user_id": get_current_user(page)["id"], "images": {},
         }
         try:
             response = supabase.table('visread_books').insert(book_doc).execute()
@@ -414,7 +421,8 @@ def new_book_view(page, get_theme, navigate_to):
 def history_view(page, get_theme, navigate_to):
     theme = get_theme()
     try:
-        response = supabase.table('visread_books').select('*').eq('user_id', current_user['id']).order('created_at', desc=True).execute()
+        # The listing only needs metadata; chapters are fetched when a book is opened
+        response = supabase.table('visread_books').select('id, title, author, created_at').eq('user_id', get_current_user(page)['id']).order('created_at', desc=True).execute()
         book_list = response.data
     except Exception as ex:
         book_list = []
@@ -434,20 +442,89 @@ def history_view(page, get_theme, navigate_to):
             color=theme["surface"], elevation=2
         )
 
-    controls = [create_book_card(book) for book in book_list] if book_list else [ft.Text("No books found.", color=theme["text"])]
+    # One picker per page; it lives in the page overlay across history re-renders.
+    # Browsers never hand the server a local file path, so web sessions get no picker.
+    if not page.web and not hasattr(page, "archive_picker"):
+        def on_archive_picked(e):
+            if e.files and e.files[0].path:
+                navigate_to("reader", archive_path=e.files[0].path, page_index=0)
+        page.archive_picker = ft.FilePicker(on_result=on_archive_picked)
+        page.overlay.append(page.archive_picker)
+        page.update()
+
+    def create_result_card(result):
+        snippet = re.sub(r"</?b>", "", result.get("snippet") or "")
+        return ft.Card(
+            ft.Container(
+                ft.ListTile(
+                    title=ft.Text(result.get('title') or 'No Title', color=theme["text"]),
+                    subtitle=ft.Text(f"Page {result['page_index'] + 1} · {snippet}", color=theme["text_muted"], max_lines=2),
+                    on_click=lambda e, r=result: navigate_to("reader", book_id=r.get("book_id"), page_index=r["page_index"], archive_path=r.get("archive_path")),
+                    trailing=ft.Icon(ft.Icons.ARROW_FORWARD_IOS, color=theme["text_muted"]),
+                ),
+                padding=ft.padding.symmetric(vertical=5)
+            ),
+            color=theme["surface"], elevation=2
+        )
+
+    history_controls = [create_book_card(book) for book in book_list] if book_list else [ft.Text("No books found.", color=theme["text"])]
+    results_column = ft.Column(history_controls, spacing=10)
+
+    def run_search(e=None, page_number=0):
+        query = (search_field.value or "").strip()
+        if not query:
+            results_column.controls = history_controls
+            page.update()
+            return
+        results, has_more = search_books(supabase, get_current_user(page)['id'], query, page=page_number)
+        if page_number == 0:
+            results_column.controls = []
+        elif results_column.controls and isinstance(results_column.controls[-1], ft.TextButton):
+            results_column.controls.pop()
+        results_column.controls.extend(create_result_card(r) for r in results)
+        if not results_column.controls:
+            results_column.controls.append(ft.Text("No matches found.", color=theme["text"]))
+        if has_more:
+            results_column.controls.append(ft.TextButton(
+                "More results", on_click=lambda e: run_search(page_number=page_number + 1),
+                style=ft.ButtonStyle(color=theme["primary"])
+            ))
+        page.update()
+
+    search_field = ft.TextField(
+        label="Search titles, authors and text", prefix_icon=ft.Icons.SEARCH,
+        border_color=theme["text_muted"], color=theme["text"], on_submit=run_search
+    )
+
     return ft.Container(
         ft.Column([
-            ft.Text("Reading History", size=24, weight=ft.FontWeight.BOLD, color=theme["text"]),
-            *controls
+            ft.Row([
+                ft.Text("Reading History", size=24, weight=ft.FontWeight.BOLD, color=theme["text"]),
+                ft.TextButton(
+                    "Open Offline Archive", icon=ft.Icons.FOLDER_OPEN,
+                    on_click=lambda e: page.archive_picker.pick_files(allowed_extensions=["epub"]),
+                    style=ft.ButtonStyle(color=theme["primary"]),
+                    visible=not page.web
+                ),
+            ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            search_field,
+            results_column
         ], spacing=10, scroll=ft.ScrollMode.ADAPTIVE),
         padding=20, expand=True, alignment=ft.alignment.top_center
     )
 
-def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0):
+def reader_view(page, get_theme, navigate_to, book_id: int = None, page_index: int = 0, archive_path: str = None):
     theme = get_theme()
+    # Books opened from an exported archive are read entirely from disk
+    archive = None
     try:
-        response = supabase.table('visread_books').select('*').eq('id', book_id).single().execute()
-        book = response.data
+        if archive_path:
+            archive = open_archive(archive_path)
+            book = archive.book
+            book_id = book.get("id")
+        else:
+            response = supabase.table('visread_books').select('*').eq('id', book_id).single().execute()
+            book = response.data
     except Exception as ex:
         return ft.View(appbar=ft.AppBar(title=ft.Text("Error"), bgcolor=theme["surface"]), controls=[ft.Text("Book not found", color=theme["error"])])
 
@@ -471,11 +548,85 @@ def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0)
         )
         page.update()
 
+    def save_image_url(url):
+        images[str(page_index)] = url
+        supabase.table('visread_books').update({'images': images}).eq('id', book_id).execute()
+        update_image(url)
+
+    def offer_reused_image(source_index, url):
+        image_display.content = ft.Stack(
+            [
+                ft.Image(src=url, fit=ft.ImageFit.CONTAIN, expand=True),
+                ft.Container(
+                    ft.Row(
+                        [
+                            ft.Text(f"Similar to page {source_index + 1}", color=theme["text"]),
+                            ft.TextButton("Keep", on_click=lambda e: save_image_url(url), style=ft.ButtonStyle(color=theme["primary"])),
+                            ft.TextButton("Generate new", on_click=regenerate_image, style=ft.ButtonStyle(color=theme["primary"])),
+                        ],
+                        alignment=ft.MainAxisAlignment.CENTER
+                    ),
+                    left=10, right=10, bottom=10, padding=5, border_radius=8,
+                    bgcolor=ft.Colors.with_opacity(0.85, theme["surface"]),
+                ),
+            ],
+            expand=True
+        )
+        page.update()
+
+    def reuse_image(match):
+        source_index, url, score = match
+        print(f"Chapter {page_index + 1} is {score:.0%} similar to chapter {source_index + 1}, reusing its image.")
+        if REUSE_MODE == "offer":
+            offer_reused_image(source_index, url)
+        else:
+            save_image_url(url)
+
+    def use_image_data(image_data):
+        # Show the local render right away; only the chosen image is uploaded
+        image_display.content = ft.Image(
+            src_base64=base64.b64encode(image_data).decode("ascii"),
+            fit=ft.ImageFit.CONTAIN,
+            expand=True
+        )
+        page.update()
+        public_id = f"{book_id}_{page_index}_{int(time.time())}"
+        new_url = upload_image_to_cloudinary(image_data, public_id)
+        if new_url:
+            save_image_url(new_url)
+
+    def fill_candidate(image_prompt):
+        # Another fill may have topped the store up while this one was queued
+        if candidate_store.count(book_id, page_index) >= CANDIDATE_COUNT - 1:
+            return
+        image_data = render_candidate(image_prompt)
+        if image_data:
+            candidate_store.add(book_id, page_index, image_data, prompt=image_prompt)
+
+    def queue_candidate_fill(image_prompt):
+        # One pool job per spare, so each render is charged against the quota
+        missing = CANDIDATE_COUNT - 1 - candidate_store.count(book_id, page_index)
+        for _ in range(max(0, missing)):
+            try:
+                generation_pool.submit(get_current_user(page)["id"], fill_candidate, image_prompt, background=True)
+            except QuotaExceeded:
+                print("Quota reached, not rendering spare candidates.")
+                return
+
     def regenerate_image(e):
         print(f"Regenerating image for chapter {page_index + 1}...")
         image_display.content = ft.ProgressRing(color=theme["primary"])
         page.update()
 
+        candidate = candidate_store.pop(book_id, page_index)
+        if candidate:
+            print("Switching to the next stored candidate.")
+            page.run_thread(use_image_data, candidate)
+            stored_prompt = candidate_store.prompt(book_id, page_index)
+            if stored_prompt:
+                queue_candidate_fill(stored_prompt)
+            return
+
         if not book.get("style_guide") and chapters:
             print("No style guide found, creating one...")
             new_guide = create_style_guide(chapters[0])
@@ -487,45 +638,141 @@ def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0)
         if str(page_index) in images:
             del images[str(page_index)]
         
-        page.run_thread(handle_image_generation)
+        # The reader asked for a new image, so never hand back a near-duplicate's
+        start_generation(allow_reuse=False)
+
+    def show_archive_image():
+        image_data = archive.read_image(page_index)
+        if image_data:
+            image_display.content = ft.Image(
+                src_base64=base64.b64encode(image_data).decode("ascii"),
+                fit=ft.ImageFit.CONTAIN,
+                expand=True
+            )
+        else:
+            image_display.content = ft.Text("No image for this page.", color=theme["text_muted"])
+        page.update()
 
-    def handle_image_generation():
-        current_image_url = images.get(str(page_index))
-        if current_image_url:
-            update_image(current_image_url)
-            return
+    progress_text = ft.Text("", color=theme["text_muted"], size=12, text_align=ft.TextAlign.CENTER)
+    progress_bar = ft.ProgressBar(width=200, color=theme["primary"], visible=False)
+    progress_panel = ft.Column(
+        [ft.ProgressRing(color=theme["primary"]), progress_text, progress_bar],
+        alignment=ft.MainAxisAlignment.CENTER,
+        horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+        spacing=10
+    )
+
+    def show_generation_progress(status):
+        eta = f" · ~{int(status['eta'])}s left" if status.get("eta") is not None else ""
+        if status["stage"] == "fallback":
+            progress_text.value = "Primary generator busy, using fallback..."
+        elif status.get("queue_position") is not None:
+            queue_size = f" of {status['queue_size']}" if status.get("queue_size") else ""
+            progress_text.value = f"In queue: position {status['queue_position'] + 1}{queue_size}{eta}"
+        elif status.get("progress") is not None:
+            progress_text.value = f"Generating: {int(status['progress'] * 100)}%{eta}"
+        else:
+            progress_text.value = f"Generating...{eta}"
+        progress_bar.value = status.get("progress")
+        progress_bar.visible = status.get("progress") is not None
+        if image_display.content is not progress_panel:
+            image_display.content = progress_panel
+        page.update()
 
+    def handle_image_generation(allow_reuse=True):
+        # Runs on the shared generation pool; only pages that need a render get here
         if page_index < len(chapters):
-            prompt = chapters[page_index]
+            paragraph = chapters[page_index]
             style_guide = book.get("style_guide")
-            image_data = generate_image(prompt, style_guide=style_guide)
+            book_index = get_book_index(book_id, chapters)
+
+            image_prompt = build_image_prompt(paragraph, style_guide=style_guide)
+            # Local prompts share the style guide and quality suffix, which would make every page look alike
+            scene = scene_part(image_prompt, style_guide)
+            book_index.add_prompt(page_index, scene)
+            if allow_reuse:
+                match = book_index.find_by_prompt(page_index, scene, images)
+                if match:
+                    reuse_image(match)
+                    return
+
+            image_data = render_image(image_prompt, on_progress=show_generation_progress)
             if image_data:
-                public_id = f"{book_id}_{page_index}_{int(time.time())}"
-                new_url = upload_image_to_cloudinary(image_data, public_id)
-                if new_url:
-                    images[str(page_index)] = new_url
-                    supabase.table('visread_books').update({'images': images}).eq('id', book_id).execute()
-                    update_image(new_url)
+                use_image_data(image_data)
+                # Spares are queued only once the visible image is done, so they never compete with it
+                queue_candidate_fill(image_prompt)
             else:
                 image_display.content = ft.Text("Image generation failed.", color=theme["error"])
             page.update()
     
-    page.run_thread(handle_image_generation)
+    # Generation state for this view; queued work is dropped when the reader leaves the page
+    generation = {"job": None, "left": False}
+
+    def prepare_image(allow_reuse=True):
+        # Stored and reused images are shown directly; they never touch the pool or the quota
+        current_image_url = images.get(str(page_index))
+        if current_image_url:
+            update_image(current_image_url)
+            return
+        if page_index >= len(chapters):
+            return
+        allow_reuse = allow_reuse and REUSE_MODE != "off"
+        if allow_reuse:
+            match = get_book_index(book_id, chapters).find_by_chapter(page_index, chapters[page_index], images)
+            if match:
+                reuse_image(match)
+                return
+        if generation["left"]:
+            return
+        try:
+            generation["job"] = generation_pool.submit(get_current_user(page)["id"], handle_image_generation, allow_reuse)
+        except QuotaExceeded as ex:
+            image_display.content = ft.Text(str(ex), color=theme["error"])
+            page.update()
+
+    def start_generation(allow_reuse=True):
+        if archive:
+            page.run_thread(show_archive_image)
+        else:
+            page.run_thread(prepare_image, allow_reuse)
+
+    def cancel_pending_generation():
+        generation["left"] = True
+        if generation["job"]:
+            generation["job"].cancel()
+
+    start_generation()
 
     def go_back(e):
+        cancel_pending_generation()
         page.views.pop()
         page.update()
 
     def go_prev(e):
+        cancel_pending_generation()
         if page_index > 0:
-            page.views[-1] = reader_view(page, get_theme, navigate_to, book_id=book_id, page_index=page_index - 1)
+            page.views[-1] = reader_view(page, get_theme, navigate_to, book_id=book_id, page_index=page_index - 1, archive_path=archive_path)
             page.update()
     
     def go_next(e):
+        cancel_pending_generation()
         if page_index + 1 < len(chapters):
-            page.views[-1] = reader_view(page, get_theme, navigate_to, book_id=book_id, page_index=page_index + 1)
+            page.views[-1] = reader_view(page, get_theme, navigate_to, book_id=book_id, page_index=page_index + 1, archive_path=archive_path)
             page.update()
 
+    def export_current_book(recompress=False):
+        def run_export():
+            try:
+                path = export_book(book, recompress=recompress)
+                message = f"Exported to {path}"
+            except Exception as ex:
+                print(f"Export failed: {ex}")
+                message = f"Export failed: {ex}"
+            page.open(ft.SnackBar(ft.Text(message)))
+
+        page.open(ft.SnackBar(ft.Text("Exporting book for offline reading...")))
+        page.run_thread(run_export)
+
     # --- Layout Components ---
     text_content = ft.Column(
         [
@@ -547,7 +794,7 @@ def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0)
             ft.IconButton(icon=ft.Icons.ARROW_BACK_IOS, on_click=go_prev, disabled=page_index == 0),
             ft.Text(f"{page_index + 1} / {len(chapters)}", color=theme["text_muted"]),
             ft.IconButton(icon=ft.Icons.ARROW_FORWARD_IOS, on_click=go_next, disabled=page_index + 1 >= len(chapters)),
-            ft.IconButton(icon=ft.Icons.REFRESH, icon_color=theme["primary"], tooltip="Regenerate Image", on_click=regenerate_image)
+            ft.IconButton(icon=ft.Icons.REFRESH, icon_color=theme["primary"], tooltip="Regenerate Image", on_click=regenerate_image, disabled=archive is not None)
         ],
         alignment=ft.MainAxisAlignment.CENTER
     )
@@ -576,6 +823,16 @@ def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0)
         appbar=ft.AppBar(
             leading=ft.IconButton(icon=ft.Icons.ARROW_BACK_IOS, on_click=go_back),
             bgcolor=theme["background"],
+            # Exports are written to the machine running VisRead, which in web mode is the server
+            actions=[] if archive or page.web else [
+                ft.PopupMenuButton(
+                    icon=ft.Icons.DOWNLOAD, tooltip="Export for Offline Reading",
+                    items=[
+                        ft.PopupMenuItem(text="Export", on_click=lambda e: export_current_book()),
+                        ft.PopupMenuItem(text="Export with smaller images", on_click=lambda e: export_current_book(recompress=True)),
+                    ]
+                )
+            ],
         ),
         padding=ft.padding.symmetric(horizontal=30, vertical=10),
         bgcolor=theme["background"],
@@ -591,7 +848,16 @@ def reader_view(page, get_theme, navigate_to, book_id: int, page_index: int = 0)
 
 # --- Application Entry Point for Desktop ---
 if __name__ == "__main__":
-    ft.app(
-        target=main,
-        assets_dir="src/assets"
-    )
+    if os.environ.get("VISREAD_WEB"):
+        # Serve every browser session from this one process
+        ft.app(
+            target=main,
+            assets_dir="src/assets",
+            view=ft.AppView.WEB_BROWSER,
+            port=int(os.environ.get("PORT", "8550"))
+        )
+    else:
+        ft.app(
+            target=main,
+            assets_dir="src/assets"
+        )
@@ -4,28 +4,52 @@ import requests
 from PIL import Image
 import time # Import the time module for delays
 import base64 # Import for decoding the new API response
+import random
 
-# --- Globals to hold initialized clients ---
-# We keep them in the global scope to reuse them after the first load.
-flux_client = None
-gemma_model = None
-imagen_model = None
+from clients import get_gemma_model, get_imagen_model, flux_pool
+from scheduler import get_scheduler
+from compaction import compact_text
+from prompt_builder import build_local_prompt
+
+# Abandon FLUX for the fallback when a job is queued deeper than this.
+FLUX_MAX_QUEUE_POSITION = int(os.environ.get("VISREAD_FLUX_MAX_QUEUE", "10"))
+FLUX_POLL_INTERVAL = 0.5
+
+# "llm" enhances prompts with Gemma, "local" uses the LLM-free prompt builder,
+# "auto" uses the local builder while Gemma requests are queueing up.
+PROMPT_MODE = os.environ.get("VISREAD_PROMPT_MODE", "llm").lower()
+AUTO_LOCAL_QUEUE_DEPTH = 2
+
+class QueueTooDeep(Exception):
+    pass
+
+def summarize_with_gemma(text: str, budget: int) -> str:
+    """Asks Gemma for a short visual summary of text; used by compaction only when needed."""
+    gemma_model = get_gemma_model()
+    if not gemma_model:
+        return None
+    print("--- Summarizing long text with Gemma ---")
+    instructional_prompt = (
+        f"Summarize the following story text in at most {budget * 3 // 5} words. "
+        "Keep only what a painter would need: the characters and their appearance, the setting, the lighting and the main action. "
+        "Only output the summary itself.\n\n"
+        f"Text: \"{text}\""
+    )
+    response = get_scheduler("gemma").run(gemma_model.generate_content, instructional_prompt)
+    return response.text.strip()
 
 def create_style_guide(paragraph: str) -> str:
     """
     Uses Gemma to create a style and character guide from the first paragraph of a story.
     """
-    global gemma_model
-    if gemma_model is None:
-        # This will trigger the lazy load and configuration
-        enhance_prompt_with_gemma("initialize")
-
+    gemma_model = get_gemma_model()
     if not gemma_model:
         print("Gemma model not available, cannot create style guide.")
         return ""
 
     print("--- Creating Style Guide with Gemma ---")
     try:
+        paragraph = compact_text(paragraph, summarize=summarize_with_gemma)
         instructional_prompt = (
             "Read the following text from the first chapter of a story. "
             "Identify the main character(s) and the overall art style. "
@@ -34,7 +58,7 @@ def create_style_guide(paragraph: str) -> str:
             "Only output the guide itself, with no extra text.\n\n"
             f"Text: \"{paragraph}\""
         )
-        response = gemma_model.generate_content(instructional_prompt)
+        response = get_scheduler("gemma").run(gemma_model.generate_content, instructional_prompt)
         guide = response.text.strip()
         print(f"--- Style Guide Created: {guide} ---")
         return guide
@@ -46,25 +70,13 @@ def enhance_prompt_with_gemma(paragraph: str, style_guide: str = None) -> str:
     """
     Enhances a prompt using the Gemma model, applying a style guide if provided.
     """
-    global gemma_model
-    
-    # Lazy load and initialize on first call
-    if gemma_model is None:
-        print("--- First time initialization: Importing google.generativeai and configuring Gemma ---")
-        import google.generativeai as genai
-        try:
-            GOOGLE_API_KEY = os.environ.get("GOOGLE_AI_API_KEY")
-            if not GOOGLE_API_KEY:
-                raise ValueError("GOOGLE_AI_API_KEY is not set.")
-            genai.configure(api_key=GOOGLE_API_KEY)
-            gemma_model = genai.GenerativeModel('gemma-3-27b-it')
-            print("--- Gemma configured successfully ---")
-        except Exception as e:
-            print(f"Error configuring Google AI for Gemma: {e}")
-            return paragraph # Return original paragraph if setup fails
+    gemma_model = get_gemma_model()
+    if not gemma_model:
+        return build_local_prompt(paragraph, style_guide) # Build locally if setup fails
 
     print("--- Enhancing Prompt with Gemma ---")
     try:
+        paragraph = compact_text(paragraph, summarize=summarize_with_gemma)
         # Build the prompt with the style guide if it exists
         if style_guide:
             instructional_prompt = (
@@ -85,29 +97,74 @@ def enhance_prompt_with_gemma(paragraph: str, style_guide: str = None) -> str:
                 f"Paragraph: \"{paragraph}\""
             )
         
-        response = gemma_model.generate_content(instructional_prompt)
+        response = get_scheduler("gemma").run(gemma_model.generate_content, instructional_prompt)
         return response.text.strip()
     except Exception as e:
         print(f"An error occurred during prompt enhancement: {e}")
-        return paragraph
+        return build_local_prompt(paragraph, style_guide)
 
-def generate_with_flux(prompt: str) -> bytes:
-    """Generates an image using the primary FLUX client (with lazy loading)."""
-    global flux_client
-    
-    # Lazy load and initialize on first call
-    if flux_client is None:
-        print("--- First time initialization: Importing gradio_client and initializing FLUX.1 ---")
-        from gradio_client import Client
+def _flux_progress(endpoint, status, eta_received):
+    """Builds a progress dict from a gradio_client StatusUpdate."""
+    stage = status.code.name.lower()
+    progress = None
+    if status.progress_data:
+        unit = status.progress_data[-1]
+        if unit.progress is not None:
+            progress = unit.progress
+        elif unit.index is not None and unit.length:
+            progress = unit.index / unit.length
+    eta = None
+    if status.eta is not None:
+        eta = max(0.0, status.eta - (time.monotonic() - eta_received))
+    return {
+        "provider": "flux",
+        "endpoint": endpoint.src,
+        "stage": stage,
+        "queue_position": status.rank,
+        "queue_size": status.queue_size,
+        "eta": eta,
+        "progress": progress,
+    }
+
+def _predict_with_flux(prompt: str, on_progress=None, seed: int = None):
+    # Acquired per attempt so a retry can land on a different endpoint
+    with flux_pool.acquire() as (endpoint, flux_client):
+        print(f"--- Attempting Image Generation with FLUX.1 ({endpoint.src}) ---")
+        if seed is None:
+            job = flux_client.submit(prompt=prompt)
+        else:
+            job = flux_client.submit(prompt=prompt, seed=seed, randomize_seed=False)
+        last_eta = None
+        eta_received = time.monotonic()
         try:
-            flux_client = Client("black-forest-labs/FLUX.1-Krea-dev")
-            print("--- FLUX.1 Client Initialized ---")
-        except Exception as e:
-            print(f"Error initializing FLUX client: {e}")
-            raise # Re-raise the exception to trigger the fallback
-
-    print("--- Attempting Image Generation with FLUX.1 ---")
-    result = flux_client.predict(prompt=prompt)
+            while not job.done():
+                status = job.status()
+                if status.eta != last_eta:
+                    last_eta = status.eta
+                    eta_received = time.monotonic()
+                if status.rank is not None:
+                    endpoint.last_queue_position = status.rank
+                    endpoint.queue_seen_at = time.monotonic()
+                    if status.rank > FLUX_MAX_QUEUE_POSITION:
+                        raise QueueTooDeep(f"Queue position {status.rank} on {endpoint.src} exceeds {FLUX_MAX_QUEUE_POSITION}.")
+                if on_progress:
+                    on_progress(_flux_progress(endpoint, status, eta_received))
+                time.sleep(FLUX_POLL_INTERVAL)
+        except BaseException:
+            # Whatever stopped the polling, the Space must not keep rendering a job
+            # nobody will collect, or the scheduler's retry would run it twice
+            job.cancel()
+            raise
+        endpoint.last_queue_position = 0
+        return job.result()
+
+def generate_with_flux(prompt: str, on_progress=None, seed: int = None) -> bytes:
+    """
+    Generates an image using the least loaded endpoint in the FLUX pool.
+    on_progress(dict) receives queue position, stage, progress and ETA while the job runs.
+    """
+    # Raises if no endpoint can be initialized, which triggers the fallback
+    result = get_scheduler("flux").run(_predict_with_flux, prompt, on_progress, seed)
     if isinstance(result, tuple):
         result_path = result[0]
     else:
@@ -118,29 +175,13 @@ def generate_with_flux(prompt: str) -> bytes:
 
 def generate_with_gemini(prompt: str) -> bytes:
     """Fallback function to generate an image using the free Gemini preview model."""
-    global imagen_model
-    
-    # Lazy load and initialize on first call
-    if imagen_model is None:
-        print("--- First time initialization: Configuring Gemini for Image Generation ---")
-        import google.generativeai as genai
-        try:
-            if gemma_model is None: # Configure if not already done
-                GOOGLE_API_KEY = os.environ.get("GOOGLE_AI_API_KEY")
-                if not GOOGLE_API_KEY:
-                    raise ValueError("GOOGLE_AI_API_KEY is not set.")
-                genai.configure(api_key=GOOGLE_API_KEY)
-            
-            imagen_model = genai.GenerativeModel('gemini-2.0-flash-preview-image-generation')
-            print("--- Gemini (Imagen) configured successfully ---")
-        except Exception as e:
-            print(f"Error configuring Gemini for Image Generation: {e}")
-            raise
+    imagen_model = get_imagen_model()
 
     print("--- Attempting Image Generation with Gemini ---")
     
         # FIX: Request both IMAGE and TEXT as required by the model
-    response = imagen_model.generate_content(
+    response = get_scheduler("gemini-image").run(
+        imagen_model.generate_content,
         contents={"parts": [{"text": prompt}]},
         generation_config={"response_modalities": ["IMAGE", "TEXT"]}
     )
@@ -154,17 +195,42 @@ def generate_with_gemini(prompt: str) -> bytes:
     # If no image part is found after checking all parts, raise an error
     raise ValueError("No image data found in Gemini response parts.")
 
-def generate_image(paragraph: str, style_guide: str = None) -> bytes:
+def build_image_prompt(paragraph: str, style_guide: str = None, mode: str = None) -> str:
+    """
+    Turns a paragraph into an image prompt. Kept separate from rendering so callers
+    can check the prompt against already generated images before paying for a render.
+    mode overrides PROMPT_MODE ("llm", "local" or "auto").
+    """
+    mode = mode or PROMPT_MODE
+    if mode == "auto" and get_scheduler("gemma").stats()["queue_depth"] >= AUTO_LOCAL_QUEUE_DEPTH:
+        print("--- Gemma is backed up, building prompt locally ---")
+        mode = "local"
+    if mode == "local":
+        return build_local_prompt(paragraph, style_guide)
+    return enhance_prompt_with_gemma(paragraph, style_guide=style_guide)
+
+def generate_image(paragraph: str, style_guide: str = None, on_progress=None) -> bytes:
     """
     Generates an image by trying the primary service first, then falling back to Gemini.
     """
-    image_prompt = enhance_prompt_with_gemma(paragraph, style_guide=style_guide)
-    
+    return render_image(build_image_prompt(paragraph, style_guide=style_guide), on_progress=on_progress)
+
+def render_candidate(image_prompt: str) -> bytes:
+    """Renders one variation of a prompt with a random seed, for the spare candidates."""
+    return render_image(image_prompt, seed=random.randrange(2 ** 31))
+
+def render_image(image_prompt: str, on_progress=None, seed: int = None) -> bytes:
+    """
+    Renders an already built prompt, trying FLUX first and falling back to Gemini.
+    """
     try:
-        image_bytes = generate_with_flux(image_prompt)
+        image_bytes = generate_with_flux(image_prompt, on_progress=on_progress, seed=seed)
         print("Successfully generated image with FLUX.1.")
     except Exception as e:
         print(f"FLUX.1 generation failed: {e}. Switching to Gemini fallback.")
+        if on_progress:
+            on_progress({"provider": "gemini", "stage": "fallback", "queue_position": None,
+                         "queue_size": None, "eta": None, "progress": None})
         try:
             image_bytes = generate_with_gemini(image_prompt)
             print("Successfully generated image with Gemini.")
@@ -0,0 +1,194 @@
+import re
+from collections import Counter
+
+from compaction import split_sentences
+
+# --- Local Prompt Builder ---
+# Builds a structured image prompt from a paragraph without any LLM call:
+# character names, setting, time of day, weather, lighting, mood and the
+# main action are picked out with keyword lexicons and capitalisation
+# heuristics, then merged with the book's style guide. It is deterministic and
+# fast enough for bulk runs and for when Gemma is slow, throttled or down.
+
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z'-]*")
+_SPEECH_RE = re.compile(r'["“][^"”]*["”]')
+
+SETTINGS = {
+    "room", "hall", "chamber", "forest", "woods", "city", "street", "alley", "castle", "tower", "village",
+    "sea", "ocean", "river", "mountain", "mountains", "field", "garden", "palace", "temple", "cave", "desert",
+    "ship", "throne", "bridge", "road", "market", "tavern", "inn", "library", "battlefield", "lake", "shore",
+    "beach", "ruins", "dungeon", "courtyard", "kitchen", "bedroom", "classroom", "school", "office", "station",
+    "train", "church", "cathedral", "graveyard", "cemetery", "harbor", "harbour", "island", "valley", "cliff",
+    "meadow", "swamp", "jungle", "camp", "house", "mansion", "cottage", "shop", "rooftop", "stairs", "corridor",
+}
+
+TIMES_OF_DAY = {
+    "dawn": "at dawn", "sunrise": "at sunrise", "morning": "in the morning", "noon": "at midday",
+    "midday": "at midday", "afternoon": "in the afternoon", "dusk": "at dusk", "sunset": "at sunset",
+    "twilight": "at twilight", "evening": "in the evening", "night": "at night", "midnight": "at midnight",
+}
+
+WEATHER = {
+    "rain": "rain", "raining": "rain", "storm": "a storm", "thunder": "a thunderstorm", "lightning": "lightning",
+    "snow": "falling snow", "snowing": "falling snow", "fog": "fog", "mist": "mist", "wind": "wind",
+    "blizzard": "a blizzard", "drizzle": "drizzle", "clouds": "heavy clouds", "haze": "haze",
+}
+
+LIGHTING = {
+    "moonlight": "soft moonlight", "moon": "moonlight", "sunlight": "warm sunlight", "sun": "sunlight",
+    "candle": "flickering candlelight", "candles": "flickering candlelight", "lantern": "lantern light",
+    "torch": "torchlight", "torches": "torchlight", "fire": "firelight", "firelight": "firelight",
+    "flames": "firelight", "glow": "a soft glow", "glowing": "a soft glow", "shadow": "deep shadows",
+    "shadows": "deep shadows", "darkness": "low-key lighting", "dark": "low-key lighting", "neon": "neon light",
+    "stars": "starlight", "starlight": "starlight", "lamp": "lamplight", "lamplight": "lamplight",
+}
+
+MOODS = {
+    "afraid": "fearful", "fear": "fearful", "terror": "terrifying", "dread": "ominous", "ominous": "ominous",
+    "sad": "melancholic", "tears": "melancholic", "grief": "sorrowful", "wept": "sorrowful", "lonely": "lonely",
+    "happy": "joyful", "laughed": "joyful", "smiled": "warm", "joy": "joyful", "love": "romantic",
+    "kissed": "romantic", "angry": "tense", "rage": "furious", "fury": "furious", "tense": "tense",
+    "silence": "quiet", "quiet": "quiet", "peaceful": "serene", "calm": "serene", "serene": "serene",
+    "blood": "violent", "battle": "epic", "war": "epic", "mysterious": "mysterious", "strange": "eerie",
+    "eerie": "eerie", "ghost": "eerie", "hope": "hopeful", "triumph": "triumphant",
+}
+
+ACTIONS = {
+    "stood", "ran", "fell", "rose", "raised", "drew", "struck", "leapt", "knelt", "walked", "rode", "flew",
+    "fought", "charged", "climbed", "held", "gripped", "turned", "collapsed", "burst", "shattered", "sat",
+    "danced", "swam", "screamed", "embraced", "watched", "stared", "reached", "opened", "fled", "waited",
+    "kissed", "cried", "wept", "read", "wrote", "looked", "entered", "jumped", "lay", "slept",
+}
+
+# Capitalised words that are not names even mid-sentence.
+_NOT_NAMES = {
+    "I", "I'm", "I'd", "I'll", "I've", "Mr", "Mrs", "Ms", "Dr", "Sir", "Lady", "Lord", "King", "Queen", "Prince",
+    "Princess", "God", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday",
+}
+
+# Common sentence openers; any other capitalised opener followed by a lowercase word is taken as a name.
+_STARTERS = {
+    "A", "An", "The", "He", "She", "It", "They", "We", "You", "His", "Her", "Its", "Their", "Our", "My", "Your",
+    "This", "That", "These", "Those", "There", "Here", "Then", "Now", "But", "And", "Or", "So", "Yet", "As",
+    "When", "While", "After", "Before", "If", "Though", "Although", "Because", "Since", "Until", "With",
+    "Without", "In", "On", "At", "By", "For", "From", "Into", "Of", "To", "Over", "Under", "Beside", "Behind",
+    "Above", "Below", "Across", "Through", "Beyond", "Inside", "Outside", "Still", "Even", "Only", "Just",
+    "Once", "Soon", "Suddenly", "Slowly", "Finally", "Perhaps", "Maybe", "No", "Not", "All", "Some", "Every",
+    "Each", "Nothing", "Something", "Everything", "Someone", "Everyone", "What", "Why", "How", "Where", "Who",
+    "Nobody", "Somebody", "Everybody", "Anyone", "Anybody", "None", "No-one",
+}
+
+DEFAULT_QUALITY = "highly detailed, cinematic composition, vivid colors"
+MAX_CHARACTERS = 3
+
+
+def _first(words, lexicon):
+    """The most frequent lexicon hit (earliest on ties), mapped through the lexicon if it is a dict."""
+    hits = Counter()
+    first_seen = {}
+    for i, w in enumerate(words):
+        if w in lexicon:
+            hits[w] += 1
+            first_seen.setdefault(w, i)
+    if not hits:
+        return None
+    word = min(hits, key=lambda w: (-hits[w], first_seen[w]))
+    return lexicon[word] if isinstance(lexicon, dict) else word
+
+
+def extract_scene(paragraph):
+    """Returns a dict of the visual elements found in a paragraph."""
+    narration = _SPEECH_RE.sub(" ", paragraph)
+    names = Counter()
+    for sentence in split_sentences(narration):
+        words = _WORD_RE.findall(sentence)
+        for i, word in enumerate(words):
+            if word.endswith("'s"):
+                word = word[:-2]
+            if not word[0].isupper() or word in _NOT_NAMES or len(word) < 2:
+                continue
+            # A sentence opener is capitalised anyway, so only trust it when it is not a common opener
+            if i == 0 and (word in _STARTERS or len(words) < 2 or words[1][0].isupper()):
+                continue
+            names[word] += 1
+    lowered = [w.lower() for w in _WORD_RE.findall(narration)]
+    action_sentence = None
+    for sentence in split_sentences(narration):
+        if any(w.lower() in ACTIONS for w in _WORD_RE.findall(sentence)):
+            action_sentence = sentence
+            break
+    return {
+        "characters": [name for name, _ in names.most_common(MAX_CHARACTERS)],
+        "setting": _first(lowered, SETTINGS),
+        "time_of_day": _first(lowered, TIMES_OF_DAY),
+        "weather": _first(lowered, WEATHER),
+        "lighting": _first(lowered, LIGHTING),
+        "mood": _first(lowered, MOODS),
+        "action": action_sentence,
+    }
+
+
+def _new_detail(value, lexicon, action_words):
+    """value, unless one of the lexicon words that map to it already appears in the action clause."""
+    if value and not any(word in action_words for word, mapped in lexicon.items() if mapped == value):
+        return value
+    return None
+
+
+def build_local_prompt(paragraph, style_guide=None):
+    """Builds a structured image prompt from a paragraph and the book's style guide."""
+    scene = extract_scene(paragraph)
+    action = scene["action"] or ""
+    # A short clause of the first action keeps the subject's pose without the whole paragraph
+    clause = " ".join(action.split()[:25]).rstrip(".,;:")
+    action_words = {w.lower() for w in _WORD_RE.findall(clause)}
+    parts = []
+    # Names and details already in the action clause are not repeated
+    characters = [name for name in scene["characters"] if name not in clause]
+    if clause:
+        parts.append(clause)
+        # Listed after the clause, since "Kael, Elara stood" would read as an address
+        if characters:
+            parts.append(f"with {' and '.join(characters)}")
+    elif characters:
+        parts.append(" and ".join(characters))
+    if scene["setting"] and scene["setting"] not in action_words:
+        parts.append(f"in a {scene['setting']}")
+    time_of_day = _new_detail(scene["time_of_day"], TIMES_OF_DAY, action_words)
+    if time_of_day:
+        parts.append(time_of_day)
+    weather = _new_detail(scene["weather"], WEATHER, action_words)
+    if weather:
+        parts.append(f"with {weather}")
+    lighting = _new_detail(scene["lighting"], LIGHTING, action_words)
+    if lighting:
+        parts.append(f"lit by {lighting}")
+    mood = _new_detail(scene["mood"], MOODS, action_words)
+    if mood:
+        parts.append(f"{mood} atmosphere")
+    if not parts:
+        parts.append(" ".join(paragraph.split()[:40]))
+    # The raw-paragraph fallback can end in its own punctuation; ". " is added below
+    prompt = ", ".join(parts).rstrip(" .,;:!?…")
+    if style_guide:
+        prompt += f". {_guide_sentence(style_guide)}"
+    return f"{prompt}. {DEFAULT_QUALITY}"
+
+
+def _guide_sentence(style_guide):
+    return style_guide.strip().rstrip(".")
+
+
+def scene_part(prompt, style_guide=None):
+    """
+    The prompt without the style guide and quality suffix that every local
+    prompt of a book shares, so prompt similarity reflects the scene alone.
+    """
+    suffix = f". {DEFAULT_QUALITY}"
+    if prompt.endswith(suffix):
+        prompt = prompt[:-len(suffix)]
+    if style_guide:
+        guide = f". {_guide_sentence(style_guide)}"
+        if prompt.endswith(guide):
+            prompt = prompt[:-len(guide)]
+    return prompt
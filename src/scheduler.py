@@ -0,0 +1,199 @@
+import os
+import random
+import threading
+import time
+
+# --- Per-Provider Request Scheduling ---
+# Each provider gets a token bucket for its configured quota plus an adaptive
+# concurrency limit (AIMD): the limit grows by one slot per "window" of
+# successful calls and is cut multiplicatively on 429s or slow responses.
+# Rate-limited and transient failures are retried with jittered backoff.
+
+# rate: requests per second, burst: bucket size, target_latency: seconds
+PROVIDER_LIMITS = {
+    "gemma": {"rate": 0.5, "burst": 5, "max_concurrency": 8, "target_latency": 15.0},
+    "gemini-image": {"rate": 0.15, "burst": 2, "max_concurrency": 2, "target_latency": 30.0},
+    "flux": {"rate": 1.0, "burst": 4, "max_concurrency": 4, "target_latency": 90.0},
+}
+
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+_RATE_LIMIT_MARKERS = ("429", "rate limit", "ratelimit", "quota", "resource exhausted", "too many requests")
+_TRANSIENT_MARKERS = ("timeout", "timed out", "deadline", "unavailable", "503", "502", "connection")
+
+
+def _is_rate_limited(error):
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    if name in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _RATE_LIMIT_MARKERS)
+
+
+def _is_transient(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__.lower()
+    if "timeout" in name or name in ("deadlineexceeded", "serviceunavailable"):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _TRANSIENT_MARKERS)
+
+
+class TokenBucket:
+    """Classic token bucket; acquire() blocks until a token is available."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProviderScheduler:
+    """Schedules calls to one provider within its quota and adaptive concurrency limit."""
+
+    def __init__(self, name, rate, burst, max_concurrency, target_latency):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.limit = 1.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    # --- AIMD concurrency control ---
+    def _enqueue(self):
+        with self._cond:
+            self.waiting += 1
+
+    def _acquire_slot(self):
+        """Moves a caller counted in waiting (see _enqueue) to in_flight once a slot is free."""
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                print(f"[{self.name}] Queued (depth {self.waiting}, limit {int(self.limit)})")
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_success(self, latency):
+        with self._cond:
+            if latency > self.target_latency:
+                self.limit = max(1.0, self.limit * 0.9)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _on_rate_limited(self):
+        with self._cond:
+            self.throttled += 1
+            self.limit = max(1.0, self.limit / 2)
+
+    # --- Public API ---
+    def run(self, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) once a token and a concurrency slot are free.
+        Retries 429s and transient errors with jittered exponential backoff,
+        re-raising the last error once MAX_RETRIES is exhausted.
+        """
+        # Callers count as queued while waiting for a token, a slot or a backoff to end
+        self._enqueue()
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self._acquire_slot()
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                rate_limited = _is_rate_limited(e)
+                if rate_limited:
+                    self._on_rate_limited()
+                if not (rate_limited or _is_transient(e)) or attempt >= MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                attempt += 1
+                print(f"[{self.name}] {type(e).__name__}: {e}. Retry {attempt}/{MAX_RETRIES} in {delay:.1f}s")
+                self._enqueue()
+            else:
+                self._on_success(time.monotonic() - started)
+                return result
+            finally:
+                self._release_slot()
+            time.sleep(delay)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "provider": self.name,
+                "queue_depth": self.waiting,
+                "in_flight": self.in_flight,
+                "concurrency_limit": int(self.limit),
+                "throttled": self.throttled,
+            }
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(provider):
+    """
+    Returns the shared scheduler for a provider. Quotas can be overridden with
+    VISREAD_<PROVIDER>_RATE, _BURST and _CONCURRENCY environment variables,
+    e.g. VISREAD_FLUX_RATE=2.
+    """
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            limits = PROVIDER_LIMITS[provider]
+            prefix = "VISREAD_" + provider.upper().replace("-", "_")
+            _schedulers[provider] = ProviderScheduler(
+                provider,
+                rate=_env_float(f"{prefix}_RATE", limits["rate"]),
+                burst=_env_float(f"{prefix}_BURST", limits["burst"]),
+                max_concurrency=int(_env_float(f"{prefix}_CONCURRENCY", limits["max_concurrency"])),
+                target_latency=limits["target_latency"],
+            )
+        return _schedulers[provider]
+
+
+def queue_depths():
+    """Returns stats() for every scheduler created so far."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return [s.stats() for s in schedulers]
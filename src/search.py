@@ -0,0 +1,218 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from export import EXPORT_DIR, open_archive
+
+# --- Library Search ---
+# Online, search runs in Postgres through the search_visread_books function
+# (see db_scheme.sql). Offline, an in-memory inverted index over exported
+# archives answers the same queries with BM25 ranking. Both return one result
+# per book pointing at the best matching page_index.
+
+PAGE_SIZE = 20
+TITLE_WEIGHT = 3.0
+AUTHOR_WEIGHT = 2.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+SNIPPET_CHARS = 160
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "he", "her", "his", "in", "is",
+    "it", "its", "of", "on", "or", "she", "that", "the", "their", "they", "this", "to", "was", "were", "with",
+}
+
+
+def tokenize(text):
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if t not in _STOPWORDS]
+
+
+def _snippet(text, terms):
+    lowered = text.lower()
+    positions = [lowered.find(t) for t in terms if lowered.find(t) >= 0]
+    start = max(0, min(positions) - SNIPPET_CHARS // 3) if positions else 0
+    snippet = text[start:start + SNIPPET_CHARS].replace("\n", " ")
+    return ("..." if start else "") + snippet + ("..." if start + SNIPPET_CHARS < len(text) else "")
+
+
+class LocalSearchIndex:
+    """Inverted index over books, keyed by an arbitrary book key (an archive path offline)."""
+
+    def __init__(self):
+        self.books = {}
+        # Chapters are stored under integer doc ids; millions of tuple keys would make the GC crawl
+        self.postings = defaultdict(dict)       # term -> {doc_id: term frequency}
+        self.meta_postings = defaultdict(dict)  # term -> {key: weighted title/author frequency}
+        self.docs = {}                          # doc_id -> (key, page_index)
+        self.doc_lengths = {}
+        self.total_length = 0
+        self._next_doc_id = 0
+        self._book_terms = {}
+        self._lock = threading.Lock()
+
+    def add_book(self, key, book, **extra):
+        """Indexes a book dict (title, author, chapters). extra is returned with each result."""
+        with self._lock:
+            self._remove(key)
+            terms = set()
+            doc_ids = []
+            for i, chapter in enumerate(book.get("chapters") or []):
+                doc_id = self._next_doc_id
+                self._next_doc_id += 1
+                tokens = tokenize(chapter)
+                counts = Counter(tokens)
+                for token, tf in counts.items():
+                    self.postings[token][doc_id] = tf
+                terms.update(counts)
+                self.docs[doc_id] = (key, i)
+                self.doc_lengths[doc_id] = len(tokens)
+                self.total_length += len(tokens)
+                doc_ids.append(doc_id)
+            meta = defaultdict(float)
+            for token in tokenize(book.get("title")):
+                meta[token] += TITLE_WEIGHT
+            for token in tokenize(book.get("author")):
+                meta[token] += AUTHOR_WEIGHT
+            for token, weight in meta.items():
+                self.meta_postings[token][key] = weight
+            terms.update(meta)
+            self._book_terms[key] = (terms, doc_ids)
+            self.books[key] = {
+                "book_id": book.get("id"),
+                "user_id": book.get("user_id"),
+                "title": book.get("title"),
+                "author": book.get("author"),
+                **extra,
+            }
+
+    def _remove(self, key):
+        entry = self._book_terms.pop(key, None)
+        if entry is None:
+            return
+        terms, doc_ids = entry
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings:
+                for doc_id in doc_ids:
+                    postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+            meta = self.meta_postings.get(term)
+            if meta:
+                meta.pop(key, None)
+                if not meta:
+                    del self.meta_postings[term]
+        for doc_id in doc_ids:
+            self.docs.pop(doc_id, None)
+            self.total_length -= self.doc_lengths.pop(doc_id, 0)
+        self.books.pop(key, None)
+
+    def remove_book(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def search(self, query, page=0, page_size=PAGE_SIZE, user_id=None):
+        """
+        Returns (results, has_more). Every query term must appear in the book.
+        With user_id, only that user's books are returned.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], False
+        with self._lock:
+            doc_count = len(self.doc_lengths) or 1
+            avg_length = self.total_length / doc_count or 1.0
+            book_scores = defaultdict(float)
+            chapter_scores = defaultdict(float)
+            book_terms = defaultdict(set)
+            for term in terms:
+                postings = self.postings.get(term, {})
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    length = self.doc_lengths[doc_id]
+                    chapter_scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                    book_terms[self.docs[doc_id][0]].add(term)
+                for key, weight in self.meta_postings.get(term, {}).items():
+                    book_scores[key] += idf * weight
+                    book_terms[key].add(term)
+
+            best_chapter = {}
+            for doc_id, score in chapter_scores.items():
+                key, i = self.docs[doc_id]
+                if key not in best_chapter or score > best_chapter[key][1]:
+                    best_chapter[key] = (i, score)
+            ranked = []
+            for key, matched in book_terms.items():
+                if len(matched) < len(terms):
+                    continue
+                if user_id is not None and self.books[key]["user_id"] != user_id:
+                    continue
+                page_index, chapter_score = best_chapter.get(key, (0, 0.0))
+                ranked.append((book_scores[key] + chapter_score, key, page_index))
+            ranked.sort(key=lambda item: item[0], reverse=True)
+            window = ranked[page * page_size:(page + 1) * page_size]
+            results = [{**self.books[key], "page_index": page_index, "rank": score} for score, key, page_index in window]
+        return results, len(ranked) > (page + 1) * page_size
+
+
+# --- Offline index over exported archives ---
+_local_index = LocalSearchIndex()
+_indexed_archives = {}
+_refresh_lock = threading.Lock()
+
+
+def get_local_index():
+    """Returns the archive index, (re)indexing any archive added or changed since the last call."""
+    with _refresh_lock:
+        current = {}
+        if os.path.isdir(EXPORT_DIR):
+            for name in os.listdir(EXPORT_DIR):
+                if name.endswith(".epub"):
+                    path = os.path.join(EXPORT_DIR, name)
+                    current[path] = os.path.getmtime(path)
+        for path in list(_indexed_archives):
+            if path not in current:
+                _local_index.remove_book(path)
+                del _indexed_archives[path]
+        for path, mtime in current.items():
+            if _indexed_archives.get(path) != mtime:
+                try:
+                    _local_index.add_book(path, open_archive(path).book, archive_path=path)
+                    _indexed_archives[path] = mtime
+                except Exception as e:
+                    print(f"Failed to index archive {path}: {e}")
+    return _local_index
+
+
+def search_local(query, page=0, page_size=PAGE_SIZE, user_id=None):
+    # Archives exported before user_id was recorded have none, so they never match a user
+    results, has_more = get_local_index().search(query, page, page_size, user_id=user_id)
+    terms = tokenize(query)
+    for result in results:
+        chapters = open_archive(result["archive_path"]).book["chapters"]
+        if result["page_index"] < len(chapters):
+            result["snippet"] = _snippet(chapters[result["page_index"]], terms)
+    return results, has_more
+
+
+def search_books(supabase, user_id, query, page=0, page_size=PAGE_SIZE):
+    """
+    Searches the user's library in Supabase, falling back to the local archive
+    index when the server cannot be reached. Returns (results, has_more).
+    """
+    try:
+        # Ask for one extra row to know whether another page exists
+        response = supabase.rpc("search_visread_books", {
+            "p_user_id": user_id,
+            "p_query": query,
+            "p_limit": page_size + 1,
+            "p_offset": page * page_size,
+        }).execute()
+        rows = response.data or []
+        return rows[:page_size], len(rows) > page_size
+    except Exception as e:
+        print(f"Server search failed, searching offline archives: {e}")
+        return search_local(query, page, page_size, user_id=user_id)
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+
+# --- Per-Session State & Shared Generation Pool ---
+# Everything that belongs to one reader lives in page.session, so concurrent
+# browser sessions served by one process never see each other's user. Image
+# generation for all sessions runs on one shared worker pool that serves users
+# round-robin, caps how many jobs each user has running, and enforces an
+# hourly per-user quota. Background jobs (spare candidates) wait in their own
+# queue, only start when the user has no foreground job waiting, and never take
+# the user's last free slot.
+
+GENERATION_WORKERS = int(os.environ.get("VISREAD_GENERATION_WORKERS", "4"))
+USER_MAX_CONCURRENT = int(os.environ.get("VISREAD_USER_MAX_CONCURRENT", "2"))
+USER_HOURLY_QUOTA = int(os.environ.get("VISREAD_USER_HOURLY_QUOTA", "120"))
+
+QUOTA_WINDOW = 3600
+
+
+def get_current_user(page):
+    return page.session.get("current_user")
+
+
+def set_current_user(page, user):
+    # SessionStorage.remove raises KeyError for a missing key, so logging out stores None
+    page.session.set("current_user", user)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class GenerationJob:
+    """A queued generation; cancel() drops it and refunds its quota charge if it has not started yet."""
+
+    def __init__(self, pool, user_id, fn, args):
+        self.pool = pool
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.charged_at = None
+        self.started = False
+        self.cancelled = False
+
+    def cancel(self):
+        with self.pool._cond:
+            if self.started or self.cancelled:
+                return not self.started
+            self.cancelled = True
+            self.pool._refund(self)
+            return True
+
+
+class GenerationPool:
+    def __init__(self, workers=GENERATION_WORKERS, per_user=USER_MAX_CONCURRENT, hourly_quota=USER_HOURLY_QUOTA):
+        self.workers = workers
+        self.per_user = per_user
+        self.hourly_quota = hourly_quota
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._background = OrderedDict()
+        self._in_flight = defaultdict(int)
+        self._history = defaultdict(deque)
+        self._threads = []
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"visread-gen-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _charge(self, user_id):
+        history = self._history[user_id]
+        now = time.monotonic()
+        while history and now - history[0] > QUOTA_WINDOW:
+            history.popleft()
+        if self.hourly_quota and len(history) >= self.hourly_quota:
+            raise QuotaExceeded(f"Generation quota of {self.hourly_quota} images per hour reached.")
+        history.append(now)
+        return now
+
+    def _refund(self, job):
+        try:
+            self._history[job.user_id].remove(job.charged_at)
+        except ValueError:
+            pass  # The charge already left the quota window
+
+    def submit(self, user_id, fn, *args, background=False):
+        """
+        Queues fn(*args) for user_id. Raises QuotaExceeded when the user is over quota.
+        background jobs only run when the user has no foreground job waiting.
+        """
+        job = GenerationJob(self, user_id, fn, args)
+        queues = self._background if background else self._queues
+        with self._cond:
+            job.charged_at = self._charge(user_id)
+            queues.setdefault(user_id, deque()).append(job)
+            self._start()
+            self._cond.notify()
+        return job
+
+    def _take(self, queues, limit, skip=()):
+        # Round-robin over users: take the first eligible user, then move them to the back.
+        for user_id in list(queues):
+            queue = queues[user_id]
+            while queue and queue[0].cancelled:
+                queue.popleft()
+            if not queue:
+                del queues[user_id]
+                continue
+            if self._in_flight[user_id] >= limit or user_id in skip:
+                continue
+            job = queue.popleft()
+            if queue:
+                queues.move_to_end(user_id)
+            else:
+                del queues[user_id]
+            return job
+        return None
+
+    def _next_job(self):
+        # Background work keeps one slot per user free for the next foreground job
+        return self._take(self._queues, self.per_user) or self._take(self._background, self.per_user - 1, skip=self._queues)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.started = True
+                self._in_flight[job.user_id] += 1
+            try:
+                job.fn(*job.args)
+            except Exception as e:
+                print(f"Generation job failed: {e}")
+            finally:
+                with self._cond:
+                    self._in_flight[job.user_id] -= 1
+                    self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": sum(len(q) for q in self._queues.values()),
+                "background": sum(len(q) for q in self._background.values()),
+                "in_flight": sum(self._in_flight.values()),
+                "users_waiting": len(self._queues),
+            }
+
+
+generation_pool = GenerationPool()
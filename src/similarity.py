@@ -0,0 +1,165 @@
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+
+# --- Near-Duplicate Paragraph Detection ---
+# One-permutation MinHash over word shingles with LSH banding. Each text is
+# hashed once per shingle (no per-permutation loop), so signing a book with
+# tens of thousands of paragraphs stays fast, and queries only compare
+# against the paragraphs that share at least one LSH band.
+
+NUM_BINS = 64
+BANDS = 16
+ROWS = NUM_BINS // BANDS
+SHINGLE_SIZE = 3
+# Texts with fewer shingles (e.g. "No." or "Yes.") are too short to match meaningfully.
+MIN_SHINGLES = 5
+
+# Minimum estimated Jaccard similarity for a paragraph to count as a duplicate.
+REUSE_THRESHOLD = float(os.environ.get("VISREAD_REUSE_THRESHOLD", "0.8"))
+# "auto" reuses the image, "offer" shows it and lets the reader keep it, "off" disables reuse.
+REUSE_MODE = os.environ.get("VISREAD_REUSE_MODE", "auto").lower()
+
+MAX_CACHED_BOOKS = 32
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+_BIN_WIDTH = (1 << 32) // NUM_BINS
+
+
+def _shingles(text):
+    words = _WORD_RE.findall(text.lower())
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def signature(text):
+    """
+    Returns a one-permutation MinHash signature (a tuple with None for empty
+    bins), or None when the text has fewer than MIN_SHINGLES shingles.
+    """
+    shingles = _shingles(text)
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    bins = [None] * NUM_BINS
+    for shingle in shingles:
+        h = zlib.crc32(shingle.encode("utf-8"))
+        b = h // _BIN_WIDTH
+        v = h % _BIN_WIDTH
+        if bins[b] is None or v < bins[b]:
+            bins[b] = v
+    return tuple(bins)
+
+
+def estimate_similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    matches = 0
+    used = 0
+    for a, b in zip(sig_a, sig_b):
+        if a is None and b is None:
+            continue
+        used += 1
+        if a == b:
+            matches += 1
+    return matches / used if used else 0.0
+
+
+class SimilarityIndex:
+    """An LSH index of MinHash signatures keyed by arbitrary hashable keys."""
+
+    def __init__(self):
+        self.signatures = {}
+        self.buckets = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _bands(self, sig):
+        for band in range(BANDS):
+            rows = sig[band * ROWS:(band + 1) * ROWS]
+            if any(r is not None for r in rows):
+                yield (band, rows)
+
+    def add(self, key, text):
+        sig = signature(text)
+        with self._lock:
+            self._remove(key)
+            if sig is None:
+                return
+            self.signatures[key] = sig
+            for band in self._bands(sig):
+                self.buckets[band].add(key)
+
+    def _remove(self, key):
+        sig = self.signatures.pop(key, None)
+        if sig is None:
+            return
+        for band in self._bands(sig):
+            self.buckets[band].discard(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def query(self, text, threshold=REUSE_THRESHOLD, exclude=None):
+        """Returns [(key, similarity), ...] at or above threshold, best first."""
+        sig = signature(text)
+        if sig is None:
+            return []
+        with self._lock:
+            candidates = set()
+            for band in self._bands(sig):
+                candidates.update(self.buckets.get(band, ()))
+            candidates.discard(exclude)
+            scored = [(key, estimate_similarity(sig, self.signatures[key])) for key in candidates]
+        scored = [item for item in scored if item[1] >= threshold]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+
+class BookIndex:
+    """Similarity indexes over one book's chapters and the enhanced prompts made for them."""
+
+    def __init__(self, chapters):
+        self.chapters = SimilarityIndex()
+        self.prompts = SimilarityIndex()
+        for i, chapter in enumerate(chapters):
+            self.chapters.add(i, chapter)
+
+    def _first_with_image(self, matches, images):
+        for index, score in matches:
+            url = images.get(str(index))
+            if url:
+                return index, url, score
+        return None
+
+    def find_by_chapter(self, page_index, chapter_text, images, threshold=REUSE_THRESHOLD):
+        """Returns (index, url, score) for a similar chapter that already has an image, or None."""
+        matches = self.chapters.query(chapter_text, threshold, exclude=page_index)
+        return self._first_with_image(matches, images)
+
+    def find_by_prompt(self, page_index, prompt, images, threshold=REUSE_THRESHOLD):
+        """Like find_by_chapter, but compares enhanced prompts."""
+        matches = self.prompts.query(prompt, threshold, exclude=page_index)
+        return self._first_with_image(matches, images)
+
+    def add_prompt(self, page_index, prompt):
+        self.prompts.add(page_index, prompt)
+
+
+_book_indexes = OrderedDict()
+_book_indexes_lock = threading.Lock()
+
+
+def get_book_index(book_id, chapters):
+    """Returns the cached BookIndex for a book, building it on first use."""
+    key = (book_id, len(chapters))
+    with _book_indexes_lock:
+        index = _book_indexes.get(key)
+        if index is not None:
+            _book_indexes.move_to_end(key)
+            return index
+    index = BookIndex(chapters)
+    with _book_indexes_lock:
+        index = _book_indexes.setdefault(key, index)
+        while len(_book_indexes) > MAX_CACHED_BOOKS:
+            _book_indexes.popitem(last=False)
+    return index